@@ -1,6 +1,10 @@
 import os
 import sys
-from typing import Union
+from typing import Union, Tuple, Callable, Iterable
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 
 import argparse
 import click
@@ -11,11 +15,134 @@ import cv2
 import PIL.Image
 import numpy as np
 
-from download_images import make_zip_file
-
 
 accepted_filetypes = ('.jpg', '.jpeg', '.png')
 
+# opencv-python is built against libjpeg-turbo, so its (SIMD) JPEG encoder is already as fast as PyTurboJPEG's.
+# The images we save are re-encodings of JPEGs, so a quality of 85 (instead of OpenCV's default of 95) trades a bit of
+# quality for about half the encoding time and file size. Optimizing the Huffman tables would make the files a bit
+# smaller still, but it takes an extra pass over each image, so it's left off
+jpeg_params = [cv2.IMWRITE_JPEG_QUALITY, 85, cv2.IMWRITE_JPEG_OPTIMIZE, 0]
+
+# Use the SIMD-optimized code paths of OpenCV (resizing, encoding, etc.)
+cv2.setUseOptimized(True)
+
+# ===========================================================================================
+
+
+# Background threads that save the images of each worker process (set in _init_worker)
+_writer = None
+# Saves of the current image that haven't finished yet (oldest first), and how many can be waiting at most, so that
+# the images waiting to be saved don't pile up in memory if saving is slower than processing them
+_pending_saves = deque()
+max_pending_saves = 8
+# Output buffers of each worker process, reused between images instead of allocating a new one per resize
+_resize_buffers = {}
+
+
+def _init_worker(n_writers: int = 2) -> None:
+    global _writer
+    # Each worker process already takes a whole core, so don't let OpenCV spawn its own threads on top of it
+    cv2.setNumThreads(1)
+    # cv2.imencode releases the GIL, so threads are enough to encode and write the outputs of an image in the
+    # background, while the worker processes its next output (e.g., resizes the next crop)
+    _writer = ThreadPoolExecutor(max_workers=n_writers)
+
+
+def _save_image(save_name: Union[str, os.PathLike], img: np.ndarray) -> None:
+    """
+    Encode and save an image; all the images we generate go through here, so it's the one place to tune the encoder.
+    :param save_name: Path to save the image at (the extension sets the format)
+    :param img: BGR image, as returned by cv2.imread
+    :return: None, the image will be saved at save_name
+    """
+    ext = os.path.splitext(save_name)[1]
+    # The JPEG parameters are only for JPEGs (multi-crop keeps the format of the original images, e.g., PNG)
+    encoded, buffer = cv2.imencode(ext, img, jpeg_params if ext.lower() in ('.jpg', '.jpeg') else [])
+    assert encoded, f'Could not save image "{save_name}"!'
+    # Write to a temporary file first and then rename it (atomic), so if save_name exists, it's a complete image
+    tmp_name = f'{save_name}.tmp'
+    with open(tmp_name, 'wb') as f:
+        # We know the final size, so allocate it all at once instead of letting the file system extend the file as
+        # it's written (posix_fallocate isn't available in Windows nor macOS, so just write it there)
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(f.fileno(), 0, buffer.size)
+        f.write(buffer)
+    os.replace(tmp_name, save_name)
+
+
+def _save_images(save_names: Iterable, imgs: Iterable) -> None:
+    """
+    Save the images using the background writer threads, without waiting for them to be saved (unless there are already
+    max_pending_saves images waiting, in which case we wait for the oldest ones first). The images must not be modified
+    afterwards, as they may still be pending; _run_in_pool waits for them at the end of each task.
+    :param save_names: Paths to save each image at
+    :param imgs: Images to save (crops should be views of the same image, so keeping them alive is free)
+    :return: None, the images will be saved at save_names
+    """
+    for save_name, img in zip(save_names, imgs):
+        if len(_pending_saves) >= max_pending_saves:
+            # Any exception while saving an earlier image is raised here
+            _pending_saves.popleft().result()
+        _pending_saves.append(_writer.submit(_save_image, save_name, img))
+
+
+def _wait_for_saves() -> None:
+    """Wait until all the pending images of this worker process are saved (raising any exception while saving them)."""
+    while _pending_saves:
+        _pending_saves.popleft().result()
+
+
+def _run_task(func: Callable, img_path: Union[str, os.PathLike]) -> None:
+    """
+    Run func on a single image and wait for its images to be saved, so that the task fails if any of them couldn't be
+    saved (and it's this image that is failing, not a later one).
+    :param func: Function that takes the path to a single image
+    :param img_path: Path to the image
+    :return: None, func is expected to save its own results
+    """
+    try:
+        func(img_path)
+    finally:
+        _wait_for_saves()
+
+
+def _iter_images(root: Union[str, os.PathLike]) -> Iterable[str]:
+    """
+    Recursively find all the images in a directory. os.scandir tells us if each entry is a file or a directory from
+    the directory listing itself, so unlike os.walk, we don't need an extra stat call per entry.
+    :param root: Path to the directory with the images
+    :return: Paths of all the images with an accepted file type
+    """
+    dirs = [root]
+    while dirs:
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif entry.name.lower().endswith(accepted_filetypes):
+                    yield entry.path
+
+
+def _run_in_pool(func: Callable, img_paths: Iterable, desc: str) -> None:
+    """
+    Run func on each image path in parallel, using one process per CPU (the work done per image is independent).
+    :param func: Picklable (i.e., module-level) function that takes the path to a single image
+    :param img_paths: Paths of the images to process
+    :param desc: Description to show in the progress bar
+    :return: None, func is expected to save its own results
+    """
+    img_paths = list(img_paths)
+    num_workers = os.cpu_count() or 1
+    # Send the paths in chunks, so the pickling and pipe round-trips are paid per chunk instead of per image; leave
+    # ~4 chunks per worker so the (uneven) work is still balanced between them, and cap it so the progress bar moves
+    chunksize = max(1, min(64, len(img_paths) // (num_workers * 4)))
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker) as executor:
+        # Consume the iterator so that the progress bar is updated (and any exception in the workers is raised)
+        list(tqdm(executor.map(partial(_run_task, func), img_paths, chunksize=chunksize),
+                  desc=desc, total=len(img_paths), unit='images'))
+
+
 # ===========================================================================================
 
 
@@ -27,42 +154,74 @@ def main():
 # ===========================================================================================
 
 
+def _cut_crops(img: np.ndarray, n_crops: int) -> Union[list, None]:
+    """
+    Cut-crop an image into n_crops squares of size min(h, w), sliding from one side to the other.
+    :param img: Image to crop
+    :param n_crops: Number of crops to make
+    :return: List of the crops (views of img, so no copy is made), or None if the image is already square
+    """
+    h, w, c = img.shape
+    # Wide image, so move from left to right
+    if w > h:
+        step_size = (w - h) // n_crops
+        return [img[:, i * step_size: h + i * step_size, :] for i in range(n_crops)]
+    # Tall image, so move from top to bottom
+    elif h > w:
+        step_size = (h - w) // n_crops
+        return [img[i * step_size: w + i * step_size, :, :] for i in range(n_crops)]
+    else:
+        # Image is square, so skip
+        return None
+
+
+def _read_image_at_least(img_path: Union[str, os.PathLike], min_size: int) -> np.ndarray:
+    """
+    Read an image, letting libjpeg decode it at 1/2, 1/4, or 1/8 of its size if its shortest side would still be at
+    least min_size after doing so. Downscaling is done in the DCT domain while decoding, so this is much faster than
+    decoding the full image (and we're going to shrink it afterwards anyway).
+    :param img_path: Path to the image
+    :param min_size: Minimum size the shortest side of the image should have
+    :return: BGR image, as returned by cv2.imread
+    """
+    # PIL only reads the header when opening, so this doesn't decode the image
+    with PIL.Image.open(img_path) as img:
+        shortest_side = min(img.size)
+    for scale, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if shortest_side // scale >= min_size:
+            return cv2.imread(img_path, flag)
+    return cv2.imread(img_path)
+
+
+def _interpolation(size: int, target_size: int) -> int:
+    """INTER_AREA is both faster and better looking when shrinking the image; INTER_LINEAR when enlarging it"""
+    return cv2.INTER_AREA if size > target_size else cv2.INTER_LINEAR
+
+
+def _cut_crop_one(img_path: Union[str, os.PathLike], save_path: Union[str, os.PathLike], n_crops: int) -> None:
+    """Cut-crop a single image into n_crops squares; see cut_crop_local_images"""
+    img_base_name = os.path.basename(img_path)
+    img_name = os.path.splitext(img_base_name)[0]
+
+    new_imgs = _cut_crops(cv2.imread(img_path), n_crops)
+    if new_imgs is None:
+        return
+    _save_images([os.path.join(save_path, f'{img_name}_{i}.jpg') for i in range(n_crops)], new_imgs)
+
+
 @main.command(name='cut-crop')
 def cut_crop_local_images(target_size: int = 1024, n_crops: int = 3) -> None:
     # TODO: detect that n_crops is None, so do the crop calculation automatically (define another function inside)
+    print('Note: cut-crop followed by resize is deprecated, use crop-resize instead (it skips saving the crops)')
     images_path = os.path.join('images', 'all', 'full_resolution')
     save_path = os.path.join('images', 'all', 'multi_cropped', f'{target_size}')
 
-    full_res_img_paths = []
-    for root, _, files in os.walk(images_path):
-        for file in files:
-            if file.endswith(accepted_filetypes):
-                full_res_img_paths.append(os.path.join(root, file))
+    full_res_img_paths = list(_iter_images(images_path))
 
     if not os.path.exists(save_path):
         os.makedirs(save_path)
 
-    for img_path in tqdm(full_res_img_paths, desc='Cropping images...', unit='images'):
-        img_base_name = os.path.basename(img_path)
-        img_name = os.path.splitext(img_base_name)[0]
-
-        img = cv2.imread(img_path)
-        h, w, c = img.shape
-        # Wide image, so move from left to right
-        if w > h:
-            step_size = (w - h) // n_crops
-            for i in range(n_crops):
-                new_img = img[:, i * step_size: h + i * step_size, :]
-                cv2.imwrite(os.path.join(save_path, f'{img_name}_{i}.jpg'), new_img)
-        # Tall image, so move from top to bottom
-        elif h > w:
-            step_size = (h - w) // n_crops
-            for i in range(n_crops):
-                new_img = img[i * step_size: w + i * step_size, :, :]
-                cv2.imwrite(os.path.join(save_path, f'{img_name}_{i}.jpg'), new_img)
-        else:
-            # Image is square, so skip
-            continue
+    _run_in_pool(partial(_cut_crop_one, save_path=save_path, n_crops=n_crops), full_res_img_paths, desc='Cropping images...')
 
     # Sanity check: number of cropped images is 3x original length
     cropped_image_paths = glob.glob(os.path.join(save_path, '*.jpg'))
@@ -73,6 +232,30 @@ def cut_crop_local_images(target_size: int = 1024, n_crops: int = 3) -> None:
 # ===========================================================================================
 
 
+def _resized_name(img_path: Union[str, os.PathLike], target_size: int) -> str:
+    """Name of the resized image, e.g., 'triple_cropped/1003_0.jpg' -> '1003_0.jpg_resized1024.jpg'"""
+    return f'{os.path.basename(img_path)}_resized{target_size}.jpg'
+
+
+def _resize_one(img_path: Union[str, os.PathLike], save_path: Union[str, os.PathLike], target_size: int) -> None:
+    """Resize a single image to (target_size, target_size); see resize_local_images"""
+    img_resized_path = os.path.join(save_path, _resized_name(img_path, target_size))
+    img = cv2.imread(img_path)
+    # Sanity check: make sure it's a square image
+    h, w, c = img.shape
+    if h != w:
+        # Skip, but leave a trail
+        print(f'"{img_path}" not a square image! Shape: ({h}, {w}, {c})')
+        return
+    # Pass: yay, so we resize and save it (there's only one image to save, so there's nothing to overlap saving it with;
+    # save it right away, so we can safely reuse the buffer)
+    if target_size not in _resize_buffers:
+        _resize_buffers[target_size] = np.empty((target_size, target_size, c), dtype=np.uint8)
+    img_resized = cv2.resize(img, (target_size, target_size), dst=_resize_buffers[target_size],
+                             interpolation=_interpolation(h, target_size))
+    _save_image(img_resized_path, img_resized)
+
+
 @main.command(name='resize')
 def resize_local_images(target_size: int = 1024) -> None:
     """
@@ -80,6 +263,7 @@ def resize_local_images(target_size: int = 1024) -> None:
     :param target_size: Target width and height of the square image
     :return: Images will be resized to the desired size
     """
+    print('Note: cut-crop followed by resize is deprecated, use crop-resize instead (it skips saving the crops)')
     images_paths = os.path.join('datasets', 'earth_view', 'triple_cropped')
     save_path = os.path.join('datasets', 'earth_view', 'resized', f'{target_size}')
     cropped_images_paths = glob.glob(os.path.join(images_paths, '*.jpg'))
@@ -87,22 +271,11 @@ def resize_local_images(target_size: int = 1024) -> None:
     if not os.path.exists(save_path):
         os.makedirs(save_path)
 
-    for img_path in tqdm(cropped_images_paths, desc='Resizing images...', unit='images'):
-        img_name = os.path.basename(img_path)
-        img_resized_path = os.path.join(save_path, f'{img_name}_resized{target_size}.jpg')
-        # Sanity check: skip if resized image already exists
-        if cv2.haveImageReader(img_resized_path):
-            continue
-        img = cv2.imread(img_path)
-        # Sanity check: make sure it's a square image
-        h, w, c = img.shape
-        if h != w:
-            # Skip, but leave a trail
-            print(f'"{img_path}" not a square image! Shape: ({h}, {w}, {c})')
-            continue
-        # Pass: yay, so we resize and save it
-        img_resized = cv2.resize(img, (target_size, target_size), interpolation=cv2.INTER_LINEAR)
-        cv2.imwrite(img_resized_path, img_resized)
+    # Sanity check: skip the images that have already been resized (list the save_path once instead of per image)
+    resized_img_names = {entry.name for entry in os.scandir(save_path)}
+    imgs_to_resize = [p for p in cropped_images_paths if _resized_name(p, target_size) not in resized_img_names]
+
+    _run_in_pool(partial(_resize_one, save_path=save_path, target_size=target_size), imgs_to_resize, desc='Resizing images...')
 
     # Sanity check: same number of resized as original images
     resized_images_paths = glob.glob(os.path.join(save_path, '*.jpg'))
@@ -113,6 +286,152 @@ def resize_local_images(target_size: int = 1024) -> None:
 # ===========================================================================================
 
 
+def _crop_resize_one(
+        img_path: Union[str, os.PathLike],
+        save_path: Union[str, os.PathLike],
+        target_size: int,
+        n_crops: int) -> None:
+    """Cut-crop a single image and resize each crop to (target_size, target_size); see crop_resize_local_images"""
+    img_name = os.path.splitext(os.path.basename(img_path))[0]
+
+    # The crops are as large as the shortest side of the image, so we only need that side to be at least target_size
+    img = _read_image_at_least(img_path, target_size)
+    crops = _cut_crops(img, n_crops)
+    if crops is None:
+        return
+    # The resized crops are saved in the background, so each one gets its own buffer
+    interpolation = _interpolation(min(img.shape[:2]), target_size)
+    new_imgs = [cv2.resize(crop, (target_size, target_size), interpolation=interpolation) for crop in crops]
+    _save_images([os.path.join(save_path, f'{img_name}_{i}.jpg') for i in range(n_crops)], new_imgs)
+
+
+@main.command(name='crop-resize')
+@click.option('--target-size', '-size', type=int, help='Size of the final square images', default=1024, show_default=True)
+@click.option('--num-crops', '-n', 'n_crops', type=int, help='Number of squares to cut-crop out of each image', default=3, show_default=True)
+@click.option('--fullres-path', '-fp', type=click.Path(), help='Path to the full resolution images', default=os.path.join(os.getcwd(), 'images'))
+@click.option('--img-save-path', '-sp', type=click.Path(), help='Path to save the resized images', default=os.path.join(os.getcwd(), 'images'))
+@click.option('--make-zip', '-z', is_flag=True, help='Make ZIP file with all the resized images (easier to move around)')
+def crop_resize_local_images(
+        target_size: int,
+        n_crops: int,
+        fullres_path: Union[str, os.PathLike],
+        img_save_path: Union[str, os.PathLike],
+        make_zip: bool) -> None:
+    """
+    Cut-crop the full resolution images and resize the crops to the desired target size, in a single pass.
+
+    This is the same as running cut-crop and resize one after the other, but each image is only decoded once, and the
+    intermediate crops are never encoded, saved, and read back from the disk.
+
+    :param target_size: Target width and height of the square images
+    :param n_crops: Number of squares to cut-crop out of each image
+    :param fullres_path: Path to the full-resolution images
+    :param img_save_path: Root path where we will save the images at
+    :param make_zip: Make a ZIP file with all the images; to be saved at './images/zip_files'
+    :return: Images will be saved at the specified path in target_sizextarget_size resolution
+    """
+    # Set the final save path for the images
+    save_path = os.path.join(img_save_path, 'all', 'cut_crop_resized', f'{target_size}')
+
+    # Get all the path images
+    full_res_img_paths = list(_iter_images(os.path.join(fullres_path, 'all', 'full_resolution')))
+
+    if not os.path.exists(save_path):
+        os.makedirs(save_path)
+
+    # Skip the images whose crops have all been saved already (useful if restarting)
+    saved_img_names = {entry.name for entry in os.scandir(save_path)}
+    imgs_to_process = [p for p in full_res_img_paths
+                       if not all(f'{os.path.splitext(os.path.basename(p))[0]}_{i}.jpg' in saved_img_names
+                                  for i in range(n_crops))]
+
+    _run_in_pool(partial(_crop_resize_one, save_path=save_path, target_size=target_size, n_crops=n_crops),
+                 imgs_to_process, desc='Cropping and resizing images...')
+
+    # Sanity check: number of resized images is n_crops times the original length
+    resized_image_paths = glob.glob(os.path.join(save_path, '*.jpg'))
+    diff = n_crops * len(full_res_img_paths) - len(resized_image_paths)
+    assert diff == 0, f'Something went wrong, missing {diff} images in {save_path}!'
+
+    # Zip if desired
+    if make_zip:
+        print(f'Making ZIP file...')
+        # Imported here, so the worker processes don't import download_images (and its dependencies) for nothing
+        from download_images import make_zip_file
+        make_zip_file(
+            parent_path_to_zip=os.path.join(img_save_path, 'all', 'cut_crop_resized'),
+            folder_to_zip=f'{target_size}',
+            zip_filename=f'all_imgs_cut-crop-resized{target_size}',
+            path_to_save_zip=os.path.join(os.getcwd(), 'images', 'zip_files'))
+
+
+# ===========================================================================================
+
+
+def _tile_params(h: int, w: int, target_size: int) -> Tuple[int, int, int, int]:
+    """
+    Get how to tile an image of size (h, w) with overlapping squares of size target_size (for multi-cropping). Only
+    plain int arithmetic, as going through NumPy for a handful of scalars costs more than the math itself.
+    :param h: Height of the image
+    :param w: Width of the image
+    :param target_size: Size of the crops
+    :return: Number of extra columns and rows to crop, and the size of the step to take column and row-wise
+    """
+    # Number of columns and rows to crop (guard against edge case where w or h == target_size); round() rounds half
+    # to even, same as np.rint
+    crop_cols = round(w / target_size) if w > target_size else 0
+    crop_rows = round(h / target_size) if h > target_size else 0
+
+    # Size of step to take when moving column and row-wise
+    width_step = (w - target_size) // crop_cols if crop_cols != 0 else 0
+    height_step = (h - target_size) // crop_rows if crop_rows != 0 else 0
+
+    return crop_cols, crop_rows, width_step, height_step
+
+
+def _multi_crop_one(img_path: Union[str, os.PathLike], save_path: Union[str, os.PathLike], target_size: int) -> None:
+    """Multi-crop a single image into squares of size target_size; see multi_crop_local_images"""
+    img_base_name = os.path.basename(img_path)  # 'images/all/full_resolution/1003.jpg' -> '1003.jpg'
+    # We will use the image name (here, a number) and the image format (.jpg)
+    img_name, ext = os.path.splitext(img_base_name)  # '1003.jpg' -> ('1003', '.jpg')
+
+    # Open image and get dimensions (cv2 already gives us a 3-channel image, so no need to convert)
+    img = cv2.imread(img_path)
+    h, w = img.shape[:2]
+
+    # Skip if target size is larger than either side
+    if all(target_size > i for i in (h, w)):
+        return
+
+    crop_cols, crop_rows, width_step, height_step = _tile_params(h, w, target_size)
+
+    # Upper-left corner (x0, y0) of each crop, going column by column (from left to right) and top to bottom in each
+    tiles = [(i * width_step, j * height_step) for i in range(crop_cols + 1) for j in range(crop_rows + 1)]
+
+    # Get all the crops
+    save_names, new_imgs = [], []
+    for idx, (x0, y0) in enumerate(tiles):
+        # Keep the original name, but add the cropped number (easier to differentiate)
+        save_name = os.path.join(save_path, f'{img_name}_cropped{idx}{ext}')  # _cropped{0,1,2,...}
+        # If the crop already exists, skip it (useful if restarting)
+        if os.path.exists(save_name):
+            continue
+
+        # Crop (a view of the original image, so no copy is made)
+        crop = img[y0: y0 + target_size, x0: x0 + target_size]
+        # If target_size is larger than one of the sides, the crop stops at the edge of the image, so pad it (to the
+        # right and bottom) with black, as PIL's crop used to do, so all the crops are target_size x target_size
+        crop_h, crop_w = crop.shape[:2]
+        if (crop_h, crop_w) != (target_size, target_size):
+            crop = cv2.copyMakeBorder(crop, 0, target_size - crop_h, 0, target_size - crop_w,
+                                      cv2.BORDER_CONSTANT, value=(0, 0, 0))
+        save_names.append(save_name)
+        new_imgs.append(crop)
+
+    # Save them all in the background
+    _save_images(save_names, new_imgs)
+
+
 @main.command(name='multi-crop')
 @click.option('--target-size', '-size', type=int, help='Size of squares to crop out of full res images', default=1024, show_default=True)
 @click.option('--fullres-path', '-fp', type=click.Path(), help='Path to the full resolution images', default=os.path.join(os.getcwd(), 'images'))
@@ -141,55 +460,19 @@ def multi_crop_local_images(
     save_path = os.path.join(img_save_path, 'all', 'multi_cropped', f'{target_size}')
 
     # Get all the path images
-    full_res_img_paths = []
-    for root, _, files in os.walk(os.path.join(fullres_path, 'all', 'full_resolution')):
-        for file in files:
-            if file.endswith(accepted_filetypes):
-                full_res_img_paths.append(os.path.join(root, file))
+    full_res_img_paths = list(_iter_images(os.path.join(fullres_path, 'all', 'full_resolution')))
 
     if not os.path.exists(save_path):
         os.makedirs(save_path)
 
-    # We go through each image, cutting it according to the dimensions and target_size
-    # TODO: optimize this loop with multithreading
-    for img_path in tqdm(full_res_img_paths, desc='Cropping images...', unit='images'):
-        img_base_name = os.path.basename(img_path)  # 'images/all/full_resolution/1003.jpg' -> '1003.jpg'
-        # We will use the image name (here, a number) and the image format (.jpg)
-        img_name, ext = os.path.splitext(img_base_name)  # '1003.jpg' -> ('1003', '.jpg')
-
-        # Open image and get dimensions
-        img = PIL.Image.open(img_path).convert('RGB')
-        w, h = img.size
-
-        # Skip if target size is larger than either side
-        if all(target_size > i for i in (h, w)):
-            continue
-
-        # Number of columns and rows to crop (guard against edge case where w or h == target_size)
-        crop_cols = int(np.rint(w / target_size)) if w / target_size > 1 else 0
-        crop_rows = int(np.rint(h / target_size)) if h / target_size > 1 else 0
-
-        # Size of step to take when moving column and row-wise
-        width_step = int((w - target_size) / crop_cols) if crop_cols != 0 else 0
-        height_step = int((h - target_size) / crop_rows) if crop_rows != 0 else 0
-
-        # Get all the crops
-        for i in range(crop_cols + 1):
-            for j in range(crop_rows + 1):
-                # Keep the original name, but add the cropped number (easier to differentiate)
-                save_name = os.path.join(save_path, f'{img_name}_cropped{2*i + j}{ext}')  # _cropped{0,1,2,...}
-                # If image exists, open it, and if there's no error, skip (useful if restarting)
-                if cv2.haveImageReader(save_name):
-                    continue
-
-                # Crop and save it
-                new_img = img.crop((i*width_step, j*height_step,  # upper-left corner
-                                    i*width_step + target_size, j*height_step + target_size))  # lower-right corner
-                new_img.save(save_name)
+    # We go through each image, cutting it according to the dimensions and target_size (one process per CPU)
+    _run_in_pool(partial(_multi_crop_one, save_path=save_path, target_size=target_size), full_res_img_paths, desc='Cropping images...')
 
     # Zip if desired
     if make_zip:
         print(f'Making ZIP file...')
+        # Imported here, so the worker processes don't import download_images (and its dependencies) for nothing
+        from download_images import make_zip_file
         make_zip_file(
             parent_path_to_zip=os.path.join(img_save_path, 'all', 'multi_cropped'),
             folder_to_zip=f'{target_size}',
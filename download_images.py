@@ -1,52 +1,71 @@
 import os
-from typing import Union, List
+from typing import Union, Tuple
+
+from functools import lru_cache
+
+from concurrent.futures import ThreadPoolExecutor
 
 import shutil
-import operator
-import json
+import zipfile
 
 import urllib
 import urllib.request
 import urllib.error
 
-import cv2  			# pip install opencv-python
+import orjson  			# pip install orjson
+import PIL.Image  		# pip install pillow
+import requests  		# pip install requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import click  			# pip install click
 from tqdm import tqdm  	# pip install tqdm
 
-from parser import get_latest_json_multi_thread
 
+# Number of images to download at the same time
+num_download_threads = 32
+
+# All the images are in the same server, so share the connections between downloads instead of making a new one
+# (and doing the TCP and TLS handshakes) per image. Also retry if the connection fails or the server is busy
+session = requests.Session()
+session.mount('https://', HTTPAdapter(
+	pool_connections=num_download_threads,
+	pool_maxsize=num_download_threads,
+	max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])))
+# Seconds to wait for the connection to open and for each read (not the whole download); a stalled connection then
+# raises an error (and is retried) instead of blocking its thread forever
+download_timeout = (3.05, 30)
 
 # ===========================================================================================
 
 
-# Helper function to easily make a zip file from a directory of images. Adapted from Sean Behan's blog
-# http://www.seanbehan.com/how-to-use-python-shutil-make_archive-to-zip-up-a-directory-recursively-including-the-root-folder/
 def make_zip_file(
 		parent_path_to_zip: Union[str, os.PathLike],
 		folder_to_zip: Union[str, os.PathLike],
 		zip_filename: str,
 		path_to_save_zip: Union[str, os.PathLike]) -> None:
 	"""
-	Auxiliary function to make it easy to create a ZIP file with the contents of a directory.
+	Auxiliary function to make it easy to create a ZIP file with the contents of a directory. The images are already
+	compressed (JPEG), so we only store them in the ZIP file; deflating them again would take a long time for ~0% gain.
 
 	:param parent_path_to_zip: Parent path containing the folder we wish to ZIP
 	:param folder_to_zip: Folder within the parent_path_to_zip that will be compressed
 	:param zip_filename: Name of the ZIP file (without .zip extension)
-	:param path_to_save_zip: Path where we will then move the ZIP file
+	:param path_to_save_zip: Path where we will save the ZIP file
 	:return: None, the saved ZIP file at the directory path_to_save_zip
 	"""
-	zip_path = shutil.make_archive(
-		base_name=zip_filename,
-		format='zip',  # for reference, options available: 'zip', 'tar', 'gztar', 'bztar', 'xztar', if so desired
-		root_dir=parent_path_to_zip,
-		base_dir=folder_to_zip)
 	# Make the save dir if it doesn't exist
 	if not os.path.exists(path_to_save_zip):
-		os.mkdir(path_to_save_zip)
-	# Move the ZIP file
-	res = shutil.move(zip_path, path_to_save_zip)
-	print(f'ZIP file saved at "{res}"!')
+		os.makedirs(path_to_save_zip)
+	zip_path = os.path.join(path_to_save_zip, f'{zip_filename}.zip')
+	# allowZip64, as the ZIP file can easily be larger than 4 GB
+	with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+		for root, _, files in os.walk(os.path.join(parent_path_to_zip, folder_to_zip)):
+			for file in sorted(files):
+				file_path = os.path.join(root, file)
+				# Keep folder_to_zip as the root dir inside the ZIP file
+				zf.write(file_path, arcname=os.path.relpath(file_path, parent_path_to_zip))
+	print(f'ZIP file saved at "{zip_path}"!')
 
 
 def download_static_json(json_path: Union[str, os.PathLike] = os.getcwd()) -> None:
@@ -58,47 +77,51 @@ def download_static_json(json_path: Union[str, os.PathLike] = os.getcwd()) -> No
 	"""
 	static_url = 'https://raw.githubusercontent.com/PDillis/earthview/master/earthview.json'
 	res = urllib.request.urlopen(static_url).read()
-	# Get the data and image URLs
-	data = json.loads(res)
+	# Make sure we got a valid JSON file; it's already formatted, so we can save it as is
+	orjson.loads(res)
 
-	with open(os.path.join(json_path, 'earthview.json'), 'w') as f:
-		json.dump(data, f, sort_keys=True, indent=4)
+	with open(os.path.join(json_path, 'earthview.json'), 'wb') as f:
+		f.write(res)
 
 # ===========================================================================================
 
 
-def get_img_urls_static_json() -> list:
+@lru_cache(maxsize=None)
+def get_img_urls_static_json() -> Tuple[str, ...]:
 	"""
 	Auxiliary function to get the image URLs using the static JSON file that can be found in the GitHub repository.
 	The downside is that more images may become available, and this JSON file won't be updated (if I ever update it).
 
-	:return: List of image URLs.
+	The result is cached, so calling it again in the same process won't download nor parse the JSON file again.
+
+	:return: Tuple of image URLs (immutable, as it's shared by all callers).
 	"""
 	# Load the json and get the image urls (2069 images in total, as of mid-March 2021)
 	static_url = 'https://raw.githubusercontent.com/PDillis/earthview/master/earthview.json'
 	res = urllib.request.urlopen(static_url).read()
 	# Get the data and image URLs
-	data = json.loads(res)
+	data = orjson.loads(res)
 
 	# We will get, for each dict in data, the image url and remove any duplicates using set
-	# I apologize if this is too obscure, as there are other simpler ways to do this
-	img_urls = list(set(map(operator.itemgetter('image'), data)))
+	img_urls = tuple({d['image'] for d in data})
 
 	return img_urls
 
 
+@lru_cache(maxsize=None)
 def get_img_urls_local(
-		processes_per_cpu: int = 8,
+		concurrency: Union[int, None] = None,
 		max_index: int = 20000,
-		json_path: Union[str, os.PathLike] = os.getcwd()) -> list:
+		json_path: Union[str, os.PathLike] = os.getcwd()) -> Tuple[str, ...]:
 	"""
 	Auxiliary function to get the image URLs that are stored in the local JSON file. If it doesn't exist, then we will
 	use the static JSON file found in the "earthview" repository in GitHub.
 
-	:param processes_per_cpu: Number of processes to run in parallel
+	:param concurrency: Maximum number of requests in flight at the same time (if we need to get the latest JSON);
+		None for parser.py's default
 	:param max_index: Maximum image url to try; try higher number as time progresses
 	:param json_path: Path to the JSON file (by default saved in the current directory).
-	:return: List of image URLs
+	:return: Tuple of image URLs (cached per set of arguments, so it's immutable as it's shared by all callers)
 	"""
 	# If JSON file doesn't exist, then generate it
 	if not os.path.isfile(os.path.join(json_path, 'earthview.json')):
@@ -107,14 +130,16 @@ def get_img_urls_local(
 			# Save some time and get the static JSON file
 			download_static_json(json_path=json_path)
 		except urllib.error.HTTPError:  # Error 404, static JSON no longer exists
-			get_latest_json_multi_thread(processes_per_cpu=processes_per_cpu, max_index=max_index, json_path=json_path)
+			# Only import the crawler (and aiohttp) when we actually need it, as it's slow to import
+			from parser import get_latest_json
+			get_latest_json(concurrency=concurrency, max_index=max_index, save_path=json_path)
 
 	# Load the json and get the image urls
-	with open(os.path.join(json_path, 'earthview.json')) as json_file:
-		data = json.load(json_file)
+	with open(os.path.join(json_path, 'earthview.json'), 'rb') as json_file:
+		data = orjson.loads(json_file.read())
 
 	# We will get, for each dict in data, the image url and remove any duplicates using set
-	img_urls = list(set(map(operator.itemgetter('image'), data)))
+	img_urls = tuple({d['image'] for d in data})
 
 	return img_urls
 
@@ -133,22 +158,77 @@ def main():
 def test_image(
 		img_save_path: Union[str, os.PathLike],
 		expected_height: int = 1200,
-		expected_width: int = 1800,
-		expected_channels: int = 3) -> None:
+		expected_width: int = 1800) -> None:
 	"""
 	Test the saved image to see if it was correctly saved (otherwise, it needs to be downloaded again).
 	:param img_save_path: Path to the image (including the image file name and extension, '.jpg')
 	:param expected_height: Expected height in pixels of the image; will be the same throughout: 1200 pixels
 	:param expected_width: Expected width in pixels of the image; will be the same throughout: 1800 pixels
-	:param expected_channels: Number of channels of the image; expected an RGB image, so 3
 	:return: None, checks will be conducted
 	"""
-	assert cv2.haveImageReader(img_save_path), f'Image "{img_save_path}" was incorrectly saved!'
+	with open(img_save_path, 'rb') as f:
+		try:
+			# PIL only reads the header when opening, so we get the dimensions without decoding the whole image
+			img = PIL.Image.open(f)
+		except PIL.UnidentifiedImageError:
+			raise AssertionError(f'Image "{img_save_path}" was incorrectly saved!')
+		# Only the dimensions are checked: the images are always read as 3-channel (BGR) images later on, so a grayscale
+		# or CMYK JPEG is still a valid image
+		w, h = img.size
+		# A complete JPEG ends with the End Of Image marker, whereas a truncated download won't
+		f.seek(-2, os.SEEK_END)
+		assert f.read(2) == b'\xff\xd9', f'Image "{img_save_path}" was incorrectly saved!'
+
+	msg = f'Image "{img_save_path}" has unexpected dimensions: ({h}, {w})'
+	assert (h, w) == (expected_height, expected_width), msg
+
+
+def download_image(
+		img_url: str,
+		img_save_path: Union[str, os.PathLike]) -> None:
+	"""
+	Download a single image and check that it was correctly saved.
 
-	img = cv2.imread(img_save_path)
-	h, w, c = img.shape
-	msg = f'Image "{img_save_path}" has unexpected dimensions: ({h}, {w}, {c})'
-	assert (h, w, c) == (expected_height, expected_width, expected_channels), msg
+	:param img_url: url of the image
+	:param img_save_path: Path to the image (including the image file name and extension, '.jpg')
+	:return: None, the image will be saved at img_save_path
+	"""
+	# Download to a temporary file and only rename it (atomic) once it's been checked, so an interrupted download
+	# won't be mistaken for an already downloaded image when restarting
+	tmp_save_path = f'{img_save_path}.tmp'
+	try:
+		with session.get(img_url, stream=True, timeout=download_timeout) as response:
+			response.raise_for_status()
+			response.raw.decode_content = True
+			with open(tmp_save_path, 'wb') as f:
+				shutil.copyfileobj(response.raw, f, length=1 << 20)
+		# Check it was correctly saved and has the expected dimensions
+		test_image(tmp_save_path)
+	except Exception:
+		# Don't leave the incomplete/invalid image behind
+		if os.path.exists(tmp_save_path):
+			os.remove(tmp_save_path)
+		raise
+	os.replace(tmp_save_path, img_save_path)
+
+
+def download_in_parallel(
+		img_urls: list,
+		img_save_paths: list,
+		num_threads: int = num_download_threads) -> None:
+	"""
+	Auxiliary function to download many images at once. The downloads are I/O bound (we're mostly waiting on the
+	server), so threads let us have many requests in flight without the GIL getting in the way.
+
+	:param img_urls: list containing the urls of the images to download
+	:param img_save_paths: list containing the paths where each image will be saved at
+	:param num_threads: Number of images to download at the same time
+	:return: None, the images will be saved at the desired paths
+	"""
+	with ThreadPoolExecutor(max_workers=num_threads) as executor:
+		# Consume the iterator so that the progress bar is updated (and any exception in the threads is raised)
+		list(tqdm(executor.map(download_image, img_urls, img_save_paths),
+				  desc='Downloading images...', total=len(img_urls), unit='images'))
 
 
 def download_all(
@@ -161,17 +241,13 @@ def download_all(
 	:param save_path: Path to save the images at
 	:return: None, the images will be saved at the desired path
 	"""
-	for img_url in tqdm(img_urls, desc='Downloading images...', unit='images'):
-		img_name = os.path.basename(img_url)  # 'https://www.gstatic.com/prettyearth/assets/full/1003.jpg' -> '1003.jpg'
-		img_save_path = os.path.join(save_path, img_name)
-		# If image exists, open it, and if there's no error, skip
-		if cv2.haveImageReader(img_save_path):
-			continue
+	# If image exists, skip it (list the save_path once instead of checking for each image)
+	downloaded_img_names = set(os.listdir(save_path))
+	# 'https://www.gstatic.com/prettyearth/assets/full/1003.jpg' -> '1003.jpg'
+	img_urls = [img_url for img_url in img_urls if os.path.basename(img_url) not in downloaded_img_names]
 
-		# Get and download the image
-		urllib.request.urlretrieve(img_url, img_save_path)
-		# Check it was correctly saved and has the expected dimensions
-		test_image(img_save_path)
+	# Get and download the images
+	download_in_parallel(img_urls, [os.path.join(save_path, os.path.basename(img_url)) for img_url in img_urls])
 
 
 @main.command(name='download-all')
@@ -228,37 +304,42 @@ def download_images(
 # ===========================================================================================
 
 
-def get_img_urls_by_country_static() -> List[tuple]:
+@lru_cache(maxsize=None)
+def get_img_urls_by_country_static() -> Tuple[tuple, ...]:
 	"""
 	Auxiliary function to get the image URLs and respective countries using the static JSON file that can be found in
 	the original repository. The downside is that more images may become available, and this JSON file won't be updated
 	as often.
 
-	:return: List of tuples of image URLs and their respective country
+	The result is cached, so calling it again in the same process won't download nor parse the JSON file again.
+
+	:return: Tuple of tuples of image URLs and their respective country (immutable, as it's shared by all callers)
 	"""
 	# Load the json and get the image urls (2069 images in total, as of mid-March 2021)
 	static_url = 'https://raw.githubusercontent.com/PDillis/earthview/master/earthview.json'
 	res = urllib.request.urlopen(static_url).read()
-	data = json.loads(res)
+	data = orjson.loads(res)
 
-	# Get a tuple of (country, img_url) for each dict in data, and remove any duplicates using set
-	imgs_by_country = list(set(map(operator.itemgetter('image', 'country'), data)))
+	# Get a tuple of (img_url, country) for each dict in data, and remove any duplicates using set
+	imgs_by_country = tuple({(d['image'], d['country']) for d in data})
 
 	return imgs_by_country
 
 
+@lru_cache(maxsize=None)
 def get_img_urls_by_country_local(
-		processes_per_cpu: int = 8,
+		concurrency: Union[int, None] = None,
 		max_index: int = 20000,
-		json_path: Union[str, os.PathLike] = os.getcwd()) -> List[tuple]:
+		json_path: Union[str, os.PathLike] = os.getcwd()) -> Tuple[tuple, ...]:
 	"""
 	Auxiliary function to get the image URLs that are stored in the local JSON file. If it doesn't exist, then we will
 	use the static JSON file found in the "earthview" repository.
 
-	:param processes_per_cpu: Number of processes to run in parallel
+	:param concurrency: Maximum number of requests in flight at the same time (if we need to get the latest JSON);
+		None for parser.py's default
 	:param max_index: Maximum image url to try; try higher number as time progresses
 	:param json_path: Path to the JSON file (by default saved in the current directory).
-	:return: List of image URLs
+	:return: Tuple of tuples of image URLs and their respective country (cached per set of arguments, so it's immutable)
 	"""
 	# If JSON file doesn't exist, then generate it
 	if not os.path.isfile(os.path.join(json_path, 'earthview.json')):
@@ -267,13 +348,15 @@ def get_img_urls_by_country_local(
 			# Save some time and get the static JSON file
 			download_static_json(json_path=json_path)
 		except urllib.error.HTTPError:  # Error 404, static JSON no longer exists
-			get_latest_json_multi_thread(processes_per_cpu=processes_per_cpu, max_index=max_index, json_path=json_path)
+			# Only import the crawler (and aiohttp) when we actually need it, as it's slow to import
+			from parser import get_latest_json
+			get_latest_json(concurrency=concurrency, max_index=max_index, save_path=json_path)
 
 	# Load the json and get the image urls
-	with open(os.path.join(json_path, 'earthview.json')) as json_file:
-		data = json.load(json_file)
-	# We will get, for each dict in data, the image url and remove any duplicates using set
-	imgs_by_country = list(set(map(operator.itemgetter('image', 'country'), data)))
+	with open(os.path.join(json_path, 'earthview.json'), 'rb') as json_file:
+		data = orjson.loads(json_file.read())
+	# We will get, for each dict in data, the image url and its country, and remove any duplicates using set
+	imgs_by_country = tuple({(d['image'], d['country']) for d in data})
 
 	return imgs_by_country
 
@@ -290,31 +373,44 @@ def download_by_country(
 	:param save_path: Path to save the images at
 	:return: None, the images will be saved at the desired path
 	"""
-	for img_url, country in tqdm(imgs_by_country, desc='Downloading images...', unit='images'):
+	# List the already downloaded images once per dir, instead of checking for each image (useful if restarting)
+	all_imgs_dir = os.path.join('images', 'all', 'full_resolution')
+	all_imgs_names = set(os.listdir(all_imgs_dir)) if os.path.isdir(all_imgs_dir) else set()
+	country_imgs_names = {}  # country -> set of image names, filled as we encounter each country
+
+	# Images that have to be downloaded (the rest are either already there, or copied over)
+	img_urls, img_save_paths = [], []
+	for img_url, country in imgs_by_country:
 		country = country.replace(' ', '')
 		# If the image doesn't belong to any country, rename to 'None'
 		if country == '':
 			country = 'None'
-		# Make the country dir if it doesn't exist
-		if not os.path.isdir(os.path.join(save_path, country)):
-			os.makedirs(os.path.join(save_path, country))
+		# Make the country dir if it doesn't exist, and get the images already in it
+		if country not in country_imgs_names:
+			os.makedirs(os.path.join(save_path, country), exist_ok=True)
+			country_imgs_names[country] = set(os.listdir(os.path.join(save_path, country)))
 
 		img_name = os.path.basename(img_url)  # 'https://www.gstatic.com/prettyearth/assets/full/1003.jpg' -> '1003.jpg'
 		img_country_save_path = os.path.join(save_path, country, img_name)
-		# If image exists, open it, and if there's no error, skip
-		if cv2.haveImageReader(img_country_save_path):
+		# If image exists, skip
+		if img_name in country_imgs_names[country]:
 			continue
 
-		# On the other hand, if it's already been downloaded in the './images/all/full_resolution' directory, copy it
-		all_imgs_path = os.path.join('images', 'all', 'full_resolution', img_name)
-		if cv2.haveImageReader(all_imgs_path):
-			res = shutil.copyfile(src=all_imgs_path, dst=img_country_save_path)
+		# On the other hand, if it's already been downloaded in the './images/all/full_resolution' directory, hard link
+		# it (same file on disk, so no data is copied), or copy it if that's not possible (e.g., different file systems)
+		all_imgs_path = os.path.join(all_imgs_dir, img_name)
+		if img_name in all_imgs_names:
+			try:
+				os.link(src=all_imgs_path, dst=img_country_save_path)
+			except OSError:
+				shutil.copyfile(src=all_imgs_path, dst=img_country_save_path)
 			continue
 
-		# Get and download the image
-		urllib.request.urlretrieve(img_url, img_country_save_path)
-		# Check it was correctly saved and has the expected dimensions
-		test_image(img_country_save_path)
+		img_urls.append(img_url)
+		img_save_paths.append(img_country_save_path)
+
+	# Get and download the images
+	download_in_parallel(img_urls, img_save_paths)
 
 
 @main.command(name='download-by-country')
@@ -1,76 +1,346 @@
 import os
-from typing import Union
+import re
+import socket
+from html import unescape
+from typing import Union, AsyncIterator, BinaryIO, Tuple, Mapping, List
 
 import click			# pip install click
-from tqdm import tqdm	# pip install tqdm
+from tqdm.asyncio import tqdm_asyncio	# pip install tqdm
 
-import urllib
-import urllib.request
-import urllib.error
+import asyncio
+import aiohttp			# pip install aiohttp
+try:
+	# The event loop runs the callbacks of thousands of sockets, so if available, use uvloop's (libuv, in C) instead of
+	# the default (pure Python) one; uvloop is not available on Windows, where the default one is used
+	import uvloop		# pip install uvloop
+except ImportError:
+	uvloop = None
+# uvloop.run was only added in uvloop 0.18, so with an older version, also use the default event loop
+run_event_loop = getattr(uvloop, 'run', asyncio.run)
+try:
+	import resource		# Only on Unix
+except ImportError:
+	resource = None
 
-import json
-from bs4 import BeautifulSoup
-
-from multiprocessing import Pool
+import orjson			# pip install orjson
 
 # ===========================================================================================
 
 
-def get_single_data(url: str) -> Union[dict, None]:
+earthview_url = 'https://earthview.withgoogle.com'
+image_url = 'https://www.gstatic.com/prettyearth/assets/full'
+# ETag and metadata of each url from the last runs (one JSON per line), to only get the pages that have changed when
+# running again. Lines are appended as the pages arrive, so an interrupted run doesn't lose what it already fetched
+cache_filename = 'earthview_etags.jsonl'
+# Requests in flight at the same time, unless set otherwise (it's lowered if needed, see get_latest_json)
+default_concurrency = 500
+# The pages always have the same shape, so the three fields we need can be taken straight from the raw bytes, without
+# decoding nor parsing the whole page: the text of the region and country <div>s, and the first link (Google Maps)
+# (attributes are matched whole, e.g., the href of "<a data-href='...' href='...'>" is the second one)
+div_text_regex = rb'<div\s(?:[^>]*?\s)?class\s*=\s*["\'][^"\']*\b%s\b[^"\']*["\'][^>]*>(?P<value>[^<]*)<'
+region_regex = re.compile(div_text_regex % b'location__region')
+country_regex = re.compile(div_text_regex % b'location__country')
+href_regex = re.compile(rb'<a\s(?:[^>]*?\s)?href\s*=\s*(["\'])(?P<value>.*?)\1')
+# Transient errors (too many requests, server errors, dropped connections...) are retried with exponential backoff
+retry_statuses = {429, 500, 502, 503, 504}
+max_retries = 3
+backoff_factor = 0.3
+
+
+async def fetch(
+		session: aiohttp.ClientSession,
+		method: str,
+		url: str,
+		headers: Union[Mapping[str, str], None] = None,
+		allow_redirects: bool = True) -> Tuple[int, Mapping[str, str], bytes]:
+	"""
+	Send a request, retrying the transient errors (status codes in retry_statuses, connection errors, and timeouts) up
+	to max_retries times. Between tries, wait for as long as the server tells us to (Retry-After header), or else for
+	backoff_factor * 2 ** try seconds, so a momentary hiccup doesn't make us lose the url.
+
+	:param session: Session shared by all the requests (so the connections are reused)
+	:param method: HTTP method, e.g., 'GET' or 'HEAD'
+	:param url: URL to request
+	:param headers: Extra headers to send
+	:param allow_redirects: Whether to follow the redirects
+	:return: Status code, headers, and body of the (last) response; if it still fails after retrying, the error is raised
+	"""
+	for attempt in range(max_retries + 1):
+		delay = backoff_factor * 2 ** attempt
+		try:
+			async with session.request(method, url, headers=headers, allow_redirects=allow_redirects) as response:
+				if response.status not in retry_statuses or attempt == max_retries:
+					return response.status, response.headers, await response.read()
+				retry_after = response.headers.get('Retry-After', '')
+				if retry_after.isdigit():  # Can also be a date, but Google sends the number of seconds
+					delay = int(retry_after)
+		except (aiohttp.ClientError, asyncio.TimeoutError):
+			if attempt == max_retries:
+				raise
+		await asyncio.sleep(delay)
+
+
+async def get_single_data(
+		session: aiohttp.ClientSession,
+		num: int,
+		cache: dict,
+		cache_file: BinaryIO,
+		failed: List[int]) -> Union[dict, None]:
 	"""
-	Get the metadata of a single url.
+	Get the metadata of a single url. If we got it in a previous run, we only ask for the page if it has changed since
+	(using its ETag), so unchanged pages aren't sent nor parsed again.
 
-	:param url: URL of Earth View image
+	:param session: Session shared by all the requests (so the connections are reused)
+	:param num: Number (index) of the Earth View image; its url is https://earthview.withgoogle.com/{num}
+	:param cache: ETag and metadata of the urls from previous runs, by number; will be updated with this url
+	:param cache_file: Opened cache file, where the new ETag and metadata of this url will be appended to
+	:param failed: Numbers of the urls that couldn't be fetched (even after retrying); this one is appended if it fails
 	:return: dictionary containing region, country, google maps and image url
 	"""
-	num = os.path.basename(url)  # https://earthview.withgoogle.com/1003 -> 1003
+	cached = cache.get(num)
+	headers = {'If-None-Match': cached['etag']} if cached is not None else {}
 	try:
-		response = urllib.request.urlopen(url)
-		html = BeautifulSoup(response.read(), features="html.parser")
-		# We will only save region, country, Google maps url, and image_url per url
-		region = html.find("div", class_="location__region").text
-		country = html.find("div", class_="location__country").text
-		everything = html.find("a", href=True)
-		gmaps_url = everything['href']
-		image = f'https://www.gstatic.com/prettyearth/assets/full/{num}.jpg'
-		return {'region': region, 'country': country, 'map': gmaps_url, 'image': image}
-	except urllib.error.HTTPError:  # Error 404: Not found -> skip
+		status, response_headers, body = await fetch(session, 'GET', f'{earthview_url}/{num}', headers=headers)
+	except (aiohttp.ClientError, asyncio.TimeoutError):
+		status = None
+	if status == 404:  # Not found -> skip
+		return None
+	if status == 304:  # Not Modified -> same metadata as last time
+		return cached['record']
+	if status != 200:  # Still failing after retrying -> keep the metadata from last time (if any)
+		if cached is not None:
+			return cached['record']
+		failed.append(num)
 		return None
+	etag = response_headers.get('ETag')
+	# We will only save region, country, Google maps url, and image_url per url
+	region = region_regex.search(body)
+	country = country_regex.search(body)
+	gmaps_url = href_regex.search(body)
+	if region is None or country is None or gmaps_url is None:  # Not an image page -> skip
+		return None
+	# HTML entities (e.g., &amp; or &#39;) are replaced, as an HTML parser would do
+	region, country, gmaps_url = (unescape(match.group('value').decode('utf-8')) for match in (region, country, gmaps_url))
+	image = f'{image_url}/{num}.jpg'
+	record = {'region': region, 'country': country, 'map': gmaps_url, 'image': image}
+	if etag is not None:
+		cache[num] = {'etag': etag, 'record': record}
+		cache_file.write(orjson.dumps({'num': num, 'etag': etag, 'record': record}) + b'\n')
+	return record
+
+
+async def image_exists(
+		session: aiohttp.ClientSession,
+		num: int) -> bool:
+	"""
+	Check if the image of a url exists. The image url is known beforehand, so we can do a HEAD request to it (no body
+	is sent back) instead of downloading and parsing the whole page of an url that will most likely not exist.
+
+	:param session: Session shared by all the requests (so the connections are reused)
+	:param num: Number (index) of the Earth View image
+	:return: Whether the image exists
+	"""
+	try:
+		status, _, _ = await fetch(session, 'HEAD', f'{image_url}/{num}.jpg', allow_redirects=False)
+	except (aiohttp.ClientError, asyncio.TimeoutError):  # Still failing after retrying -> let the page request decide
+		return True
+	return status == 200 or status in retry_statuses
+
+
+async def get_all_data(
+		concurrency: int,
+		max_index: int,
+		cache: dict,
+		cache_file: BinaryIO,
+		failed: List[int]) -> AsyncIterator[dict]:
+	"""
+	Get the metadata of all the urls up to max_index. The work is pure network I/O, so a single event loop can have
+	thousands of requests in flight at once, all sharing the same (kept-alive) connections to Earth View/gstatic.
+
+	:param concurrency: Maximum number of requests in flight at the same time
+	:param max_index: Maximum image url to try
+	:param cache: ETag and metadata of the urls from previous runs, by number; will be updated with the new ones
+	:param cache_file: Opened cache file, where the new ETags and metadata will be appended to
+	:param failed: Numbers of the urls that couldn't be fetched (even after retrying); will be appended to
+	:return: Metadata of each existing url, yielded as soon as it arrives (in no particular order)
+	"""
+	# All the urls are in two hosts (Earth View for the pages, gstatic for the images), so after the first requests all
+	# the others reuse an open (kept-alive) connection instead of doing the TCP and TLS handshakes again. aiohttp only
+	# speaks HTTP/1.1 (one request at a time per connection), so we still need one connection per request in flight, but
+	# these handshakes are only done at the start. Keep idle connections around for a while, so they don't get closed
+	# (and have to be opened again) whenever the parsing momentarily stalls the requests. The two hosts are resolved once
+	# and cached for the whole crawl (only asking for their IPv4 addresses), instead of once per new connection
+	connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency, keepalive_timeout=60,
+									 use_dns_cache=True, ttl_dns_cache=600, family=socket.AF_INET)
+	# Fail fast on a connection that doesn't open or a response that stalls, as it will be retried anyway
+	timeout = aiohttp.ClientTimeout(total=30, sock_connect=3.05, sock_read=10)
+	async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+		# Instead of scheduling one task per url at once, a fixed number of workers take the numbers from a (bounded)
+		# queue, so the pending urls and their responses are limited by the concurrency, no matter how high max_index is
+		num_queue = asyncio.Queue(maxsize=2 * concurrency)
+		record_queue = asyncio.Queue(maxsize=2 * concurrency)
+
+		async def produce() -> None:
+			for num in range(max_index):
+				await num_queue.put(num)
+
+		async def work() -> None:
+			while True:
+				num = await num_queue.get()
+				try:
+					# Most indices don't exist, so check first with a cheap HEAD request to the image, and only then
+					# fetch and parse its page; the ones that don't exist are skipped right here, in the same pass
+					if await image_exists(session, num):
+						record = await get_single_data(session, num, cache, cache_file, failed)
+					else:
+						record = None
+				except Exception as e:  # Hand it over, so it's raised (instead of waiting forever for this record)
+					await record_queue.put(e)
+					return
+				await record_queue.put(record)
+
+		tasks = [asyncio.create_task(produce())] + [asyncio.create_task(work()) for _ in range(concurrency)]
+		try:
+			# We get one result per url, so we know when we're done without having to tell the workers to stop
+			for _ in tqdm_asyncio(range(max_index), desc='Fetching...', unit='urls'):
+				record = await record_queue.get()
+				if isinstance(record, Exception):
+					raise record
+				# Skip the urls that don't exist or couldn't be fetched (error 404)
+				if record is not None:
+					yield record
+		finally:
+			for task in tasks:
+				task.cancel()
+			await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def save_all_data(
+		concurrency: int,
+		max_index: int,
+		cache: dict,
+		cache_file: BinaryIO,
+		failed: List[int],
+		json_path: Union[str, os.PathLike]) -> int:
+	"""
+	Get the metadata of all the urls up to max_index and save it to a JSON file. Each record is written as soon as it
+	arrives, so we never hold all of them in a list. It's written to a temporary file (json_path + '.tmp'), which is
+	left to the caller to rename (atomic) to json_path, so the JSON file is always valid, even if the code is
+	interrupted while getting the data or saving it.
+
+	:param concurrency: Maximum number of requests in flight at the same time
+	:param max_index: Maximum image url to try
+	:param cache: ETag and metadata of the urls from previous runs, by number; will be updated with the new ones
+	:param cache_file: Opened cache file, where the new ETags and metadata will be appended to
+	:param failed: Numbers of the urls that couldn't be fetched (even after retrying); will be appended to
+	:param json_path: Path to the JSON file
+	:return: Number of images found
+	"""
+	num_images = 0
+	tmp_path = f'{json_path}.tmp'
+	with open(tmp_path, 'wb') as f:
+		f.write(b'[')
+		async for record in get_all_data(concurrency, max_index, cache, cache_file, failed):
+			# Same layout as a whole list dumped with indent=2 (each record indented one level more)
+			dumped = orjson.dumps(record, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+			f.write(b',\n  ' if num_images else b'\n  ')
+			f.write(dumped.replace(b'\n', b'\n  '))
+			num_images += 1
+		f.write(b'\n]')
+	return num_images
+
+
+def get_latest_json(
+		concurrency: Union[int, None] = None,
+		max_index: int = 20000,
+		save_path: Union[str, os.PathLike] = os.getcwd(),
+		allow_partial: bool = False) -> None:
+	"""
+	Get the latest JSON file by going through all the urls of the images found in Earth View.
+
+	:param concurrency: Maximum number of requests in flight at the same time (default_concurrency if None)
+	:param max_index: Maximum image url to try; try higher number as time progresses, though current highest is 14793
+	:param save_path: Path where the JSON file will be saved at (current directory is the default)
+	:param allow_partial: Replace an existing JSON file even if some urls couldn't be fetched (so it may have less images)
+	:return: (None) JSON file will be saved at the save_path
+	"""
+	# Each request in flight has its own socket, and the idle connections to both hosts are kept open, so stay well
+	# below the limit of open files of the process (only letting the user know if they asked for a higher value)
+	asked_concurrency = concurrency
+	concurrency = default_concurrency if concurrency is None else concurrency
+	if resource is not None:
+		max_concurrency = max(1, (resource.getrlimit(resource.RLIMIT_NOFILE)[0] - 64) // 2)
+		if concurrency > max_concurrency:
+			if asked_concurrency is not None:
+				print(f'Lowering the concurrency from {concurrency} to {max_concurrency} (limit of open files)...')
+			concurrency = max_concurrency
+	# There's no point in having more workers than urls
+	concurrency = max(1, min(concurrency, max_index))
+
+	if not os.path.isdir(save_path):
+		os.makedirs(save_path)
+	# Load the ETags from the previous runs (if any), so that we only get the pages that have changed since; the
+	# latest line of each url is the one that counts
+	cache_path = os.path.join(save_path, cache_filename)
+	cache = {}
+	if os.path.isfile(cache_path):
+		with open(cache_path, 'rb') as f:
+			for line in f:
+				try:
+					entry = orjson.loads(line)
+				except orjson.JSONDecodeError:  # Last line of an interrupted run may be incomplete -> skip
+					continue
+				# int() also reads the (string) numbers saved by earlier versions of this code
+				cache[int(entry['num'])] = {'etag': entry['etag'], 'record': entry['record']}
+
+	print(f'Saving the JSON file at "{save_path}"...')
+	json_path = os.path.join(save_path, 'earthview.json')
+	failed = []
+	with open(cache_path, 'ab') as cache_file:
+		num_images = run_event_loop(save_all_data(
+			concurrency=concurrency, max_index=max_index, cache=cache, cache_file=cache_file, failed=failed,
+			json_path=json_path))
+	print(f'Found {num_images} images!')
+	if failed:
+		failed.sort()
+		print(f'{len(failed)} urls could not be fetched (even after retrying): '
+			  f'{", ".join(map(str, failed[:20]))}{", ..." if len(failed) > 20 else ""}')
+	if failed and not allow_partial and os.path.isfile(json_path):
+		# Don't replace a (possibly complete) JSON file with one that's missing some images
+		os.remove(f'{json_path}.tmp')
+		print(f'Keeping the previous "{json_path}"; run again, or use --allow-partial to replace it anyway')
+	else:
+		# Overwrite any previous JSON file (appending to it would make it an invalid JSON file)
+		os.replace(f'{json_path}.tmp', json_path)
+
+	# Compact the cache file, so it doesn't keep growing with every run (one line per url)
+	tmp_path = f'{cache_path}.tmp'
+	with open(tmp_path, 'wb') as f:
+		for num, cached in cache.items():
+			f.write(orjson.dumps({'num': num, **cached}) + b'\n')
+	os.replace(tmp_path, cache_path)
 
 
 @click.command()
-@click.option('-p', '--processes-per-cpu', type=click.INT, help='Number of processes to run in parallel per cpu', default=8, show_default=True)
+@click.option('-c', '--concurrency', type=click.INT, help=f'Maximum number of requests in flight at the same time  [default: {default_concurrency}]', default=None)
 @click.option('-idx', '--max-index', type=click.INT, help='Max url index to try (increase as time progresses)', default=20000, show_default=True)
 @click.option('-pth', '--save-path', type=click.Path(), help='Path to save the JSON file', default=os.getcwd(), show_default=True)
+@click.option('--allow-partial', is_flag=True, help='Replace the JSON file even if some urls could not be fetched')
 def get_latest_json_multi_thread(
-		processes_per_cpu: int,
-		max_index: int, save_path:
-		Union[str, os.PathLike]):
+		concurrency: Union[int, None],
+		max_index: int,
+		save_path: Union[str, os.PathLike],
+		allow_partial: bool):
 	"""
 	Get the latest JSON file by going through all the urls of the images found in Earth View.
-	
-	:param processes_per_cpu: Number of processes per cpu to run in parallel (8 works good enough for me)
+
+	:param concurrency: Maximum number of requests in flight at the same time (500 works good enough for me)
 	:param max_index: Maximum image url to try; try higher number as time progresses, though current highest is 14793
 	:param save_path: Path where the JSON file will be saved at (current directory is the default)
+	:param allow_partial: Replace an existing JSON file even if some urls couldn't be fetched (so it may have less images)
 	:return: (None) JSON file will be saved at the save_path
 	"""
-	urls = [f'https://earthview.withgoogle.com/{x}' for x in range(max_index)]
-
-	processes = os.cpu_count() * processes_per_cpu
-	pool = Pool(processes=processes)
-	# Thanks to Elmar Pruesse on which map to use with tqdm (otherwise it's silent and you question your sanity):
-	# https://github.com/tqdm/tqdm/issues/484#issuecomment-461998250
-	with pool as p:
-		results = list(tqdm(p.imap(func=get_single_data, iterable=urls),
-							desc='Fetching...', total=len(urls), unit='urls'))
-	# Remove None entries (404 error)
-	results = list(filter(None, results))
-	print(f'Found {len(results)} images!')
-	print(f'Saving the JSON file at "{save_path}"...')
-	if not os.path.isdir(save_path):
-		os.makedirs(save_path)
-	with open(os.path.join(save_path, 'earthview.json'), 'a') as f:
-		json.dump(results, f, sort_keys=True, indent=4)
+	get_latest_json(concurrency=concurrency, max_index=max_index, save_path=save_path, allow_partial=allow_partial)
 
 
 # ===========================================================================================